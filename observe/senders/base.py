@@ -1,13 +1,31 @@
+import asyncio
 import atexit
+import collections
+import concurrent.futures
+import gzip
 import json
 import os
+import queue
+import random
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import socket
 import threading
 import time
 import traceback
 import uuid
-from typing import(List, Optional)
+from typing import(Deque, List, Optional)
 
 # Some tunables that are typically Just Fine (tm) the way they are,
 # but can be tweaked for special circumstances.
@@ -19,6 +37,75 @@ BATCH_SEND_DELAY = max(1.0, min(float(os.getenv("OBSERVE_BATCH_SEND_DELAY", "1.0
 # how much to save in backlogs if the HTTP interface fails (note
 # that this is approximate)
 MAX_BACKLOG_SAVE = min(1024*1024, max(0, int(os.getenv("OBSERVE_MAX_BACKLOG_SAVE", 256*1024))))
+# cap on bytes queued in memory awaiting send; observations enqueued
+# beyond this are dropped (and counted) so memory stays bounded even
+# when the collector is unreachable (note that this is approximate)
+MAX_PENDING_SAVE = max(MAX_BACKLOG_SAVE, int(os.getenv("OBSERVE_MAX_PENDING_SAVE", 4*1024*1024)))
+# opt in to posting through httpx.AsyncClient on a background asyncio
+# loop instead of threaded requests (multiplexes in-flight batches over
+# one connection, HTTP/2 when the h2 extra is installed); silently falls
+# back to requests when httpx isn't available
+ASYNC_SENDS = os.getenv("OBSERVE_ASYNC", "") not in ("", "0")
+# gzip the request bodies; langchain runs repeat the same keys in every
+# record, so batches typically shrink 5-10x at compresslevel=1, which is
+# nearly free CPU-wise. Set OBSERVE_GZIP=0 if your collector can't
+# accept Content-Encoding: gzip
+GZIP_SENDS = os.getenv("OBSERVE_GZIP", "1") not in ("", "0")
+# number of concurrent POST workers; more than one overlaps slow POSTs
+# so a latency spike doesn't stall ingestion, at the cost of batches
+# arriving out of order (records carry timestamps, so Observe ingest
+# doesn't mind)
+SEND_WORKERS = max(1, min(4, int(os.getenv("OBSERVE_SEND_WORKERS", "1"))))
+# opt in to adaptively tuning the batch delay (between half and double
+# BATCH_SEND_DELAY) based on how full recent batches have been
+ADAPTIVE_BATCHING = os.getenv("OBSERVE_ADAPTIVE_BATCHING", "") not in ("", "0")
+# the batch size the adaptive delay steers toward
+TARGET_BATCH_SIZE = max(1, int(os.getenv("OBSERVE_TARGET_BATCH_SIZE", "64")))
+
+# pushed onto the queue by close() so the sender thread wakes right away
+# instead of waiting out its batch-delay timeout
+_SHUTDOWN = object()
+
+# HTTPAdapter that disables Nagle on the pooled connection (small NDJSON
+# batches shouldn't stall behind delayed ACKs) and turns on TCP keepalive
+# so the long-lived connection doesn't silently die between batches.
+class _SocketOptionsAdapter(HTTPAdapter):
+    _SOCKET_OPTIONS = [
+        (socket.IPPROTO_TCP, socket.TCP_NODELAY, 1),
+        (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+    ]
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs['socket_options'] = self._SOCKET_OPTIONS
+        super().init_poolmanager(*args, **kwargs)
+
+# Runs an httpx.AsyncClient on a private asyncio loop in a background
+# thread. Callers block on post() as they would with requests, but all
+# in-flight batches share one multiplexed connection (HTTP/2 when the h2
+# extra is installed) instead of one socket per worker thread.
+class _AsyncPoster(object):
+    def __init__(self, headers: dict):
+        try:
+            self._client = httpx.AsyncClient(http2=True, headers=headers,
+                limits=httpx.Limits(max_keepalive_connections=1),
+                timeout=httpx.Timeout(30.0, connect=5.0))
+        except ImportError:
+            # the h2 extra isn't installed; HTTP/1.1 keep-alive still works
+            self._client = httpx.AsyncClient(headers=headers,
+                limits=httpx.Limits(max_keepalive_connections=1),
+                timeout=httpx.Timeout(30.0, connect=5.0))
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, daemon=True, name='observe-async')
+        self._thread.start()
+
+    def post(self, url: str, body: bytes) -> None:
+        fut = asyncio.run_coroutine_threadsafe(self._client.post(url, content=body), self._loop)
+        fut.result().raise_for_status()
+
+    def close(self) -> None:
+        asyncio.run_coroutine_threadsafe(self._client.aclose(), self._loop).result()
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
 
 # The ObserveTracer you want to create and attach to your operations.
 class ObserveSender(object):
@@ -74,15 +161,72 @@ class ObserveSender(object):
         self.metadata_key = metadata_key
         self.accept_no_config = accept_no_config
         self.log_sends = log_sends
+        self._closed = threading.Event()
         myurl = self._derive_url(path)
         if not myurl:
             if self.accept_no_config:
+                self._closed.set()
                 return
             self._raise_config_missing()
         self.url: str = myurl
+        # one keep-alive connection reused across batches, with retries for
+        # transient collector errors, instead of a fresh TCP+TLS handshake
+        # per POST
+        self.session = requests.Session()
+        # allowed_methods=None retries POST too (urllib3 skips it by
+        # default as non-idempotent, which would make the status retries
+        # dead config); safe here because the NDJSON body is replayable
+        # bytes and ingest is timestamped
+        self.session.mount('https://', _SocketOptionsAdapter(
+            pool_connections=1, pool_maxsize=SEND_WORKERS,
+            max_retries=Retry(total=3, backoff_factor=0.25, allowed_methods=None, status_forcelist=[429, 500, 502, 503, 504])))
+        self.headers = {
+            'Content-Type': 'application/x-ndjson',
+            'Authorization': f'Bearer {self.authtoken}',
+            }
+        if GZIP_SENDS:
+            self.headers['Content-Encoding'] = 'gzip'
+        # install the headers on the session so they aren't passed (and
+        # merged into a fresh dict) on every post call
+        self.session.headers.update(self.headers)
+        self._async: Optional[_AsyncPoster] = _AsyncPoster(self.headers) if (ASYNC_SENDS and httpx) else None
         self.metadata = self._gather_metadata()
-        self.queue: List[dict] = []
-        self.cond = threading.Condition()
+        # pre-serialize the invariant metadata once; enqueue splices these
+        # byte fragments around the per-event timestamp instead of merging
+        # and re-serializing the metadata dict for every record
+        meta_fragment = maybe_json(self.metadata)[1:-1]
+        if self.metadata_key:
+            self._reserved_keys = {self.metadata_key, "what"}
+            self._meta_pre = maybe_json(self.metadata_key) + b':{' + meta_fragment + b',"timestamp":"'
+            self._meta_mid = b'"},"what":'
+        elif self.metadata_key != '':
+            self._reserved_keys = set(self.metadata) | {"timestamp", "what"}
+            self._meta_pre = meta_fragment + b',"timestamp":"'
+            self._meta_mid = b'","what":'
+        else:
+            self._reserved_keys = None
+        # producers hand pre-serialized NDJSON lines to the sender thread
+        # through a C-level queue; no Python lock is held while building
+        # or posting batches
+        self._q: queue.SimpleQueue = queue.SimpleQueue()
+        self._retry: Deque[bytes] = collections.deque()
+        # the byte count and drop counter are touched by every producer
+        # and the sender thread; unsynchronized += would drift over time,
+        # so they share a lock held only for the integer update
+        self._queued_lock = threading.Lock()
+        self._queued_bytes = 0
+        self.dropped = 0
+        self._fail_count = 0
+        self._warned_errors = set()
+        self._delay = BATCH_SEND_DELAY
+        self._batch_ema = float(TARGET_BATCH_SIZE)
+        # with more than one worker, the sender thread only cuts batches
+        # and dispatches them; the pool posts them concurrently, with a
+        # semaphore capping how many batches are in flight
+        self._executor: Optional[concurrent.futures.ThreadPoolExecutor] = None
+        if SEND_WORKERS > 1:
+            self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=SEND_WORKERS, thread_name_prefix='observe-post')
+            self._inflight = threading.Semaphore(SEND_WORKERS)
         self.last_send = time.time()
         atexit.register(self.close)
         self.sending: Optional[threading.Thread] = threading.Thread(target=self._send_thread, daemon=True, name="observe not closed")
@@ -90,36 +234,76 @@ class ObserveSender(object):
 
     def enqueue(self, what: str, data: dict) -> None:
         """enqueue a dict of data (must be JSON marshal-able) to be sent to the
-        configured Observe collector"""
-        with self.cond:
-            # did I close already?
-            if not self.sending:
-                # it could be I'm just OK with not being available
-                if self.accept_no_config:
-                    return
-                raise Exception('attempt to enqueue observations when already closed')
-            timestamp = str(int(time.time()*1e9))
+        configured Observe collector
+
+        Safe to call from many threads at once: the record is serialized on
+        the caller's thread and handed to the sender in a single C-level
+        queue operation; the only shared state touched is the queued-bytes
+        accounting, under a lock held just for the integer update. Keep it
+        that way -- don't add work to this path that holds a lock for more
+        than a moment.
+        """
+        # did I close already (or was I never configured)?
+        if self._closed.is_set():
+            # it could be I'm just OK with not being available
+            if self.accept_no_config:
+                return
+            raise Exception('attempt to enqueue observations when already closed')
+        # serialization happens here on the caller's thread (usually blocked
+        # on LLM I/O anyway), so the sender thread only concatenates and posts
+        if self._reserved_keys is None:
+            self._put_line(maybe_json(data, self.log_sends))
+        elif self._reserved_keys.isdisjoint(data):
+            # the common case: splice the pre-serialized metadata fragment
+            # into the record's bytes, skipping the dict merge entirely
+            head = maybe_json(data, self.log_sends)[:-1]
+            if head != b'{':
+                head += b','
+            self._put_line(head + self._meta_pre + str(time.time_ns()).encode() + self._meta_mid + maybe_json(what) + b'}')
+        else:
+            # a caller key collides with the metadata; fall back to the
+            # dict merge so the caller's keys still win
+            timestamp = str(time.time_ns())
             if self.metadata_key:
-                self.queue.append(merge(data, {self.metadata_key: merge(self.metadata, {"timestamp":timestamp}), "what":what}))
-            elif self.metadata_key != '':
-                self.queue.append(merge(data, self.metadata, {"timestamp":timestamp, "what":what}))
+                record = {self.metadata_key: {**self.metadata, "timestamp":timestamp}, "what":what, **data}
+            else:
+                record = {**self.metadata, "timestamp":timestamp, "what":what, **data}
+            self._put_line(maybe_json(record, self.log_sends))
+
+    # Hand one serialized line to the sender thread, unless the queue has
+    # grown past MAX_PENDING_SAVE, in which case the line is dropped (and
+    # counted) to keep memory bounded while the collector is unreachable.
+    def _put_line(self, line: bytes) -> None:
+        with self._queued_lock:
+            if self._queued_bytes > MAX_PENDING_SAVE:
+                self.dropped += 1
+                dropped = self.dropped
             else:
-                self.queue.append(data)
-            self.cond.notify()
+                self._queued_bytes += len(line)
+                dropped = 0
+        if dropped:
+            if dropped == 1 or dropped % 1000 == 0:
+                print(f'WARNING: ObserveSender dropped={dropped} observations because queue exceeds {MAX_PENDING_SAVE} bytes', flush=True)
+            return
+        self._q.put(line)
 
     def close(self) -> None:
         """Flush all pending data and wait for it to be posted. Stop accepting new data.
 
         If the final post fails, the data are lost.
         """
-        with self.cond:
-            if self.sending:
-                atexit.unregister(self.close)
-                thr = self.sending
-                self.sending = None
-                self.cond.notify()
+        thr = None
+        if not self._closed.is_set():
+            self._closed.set()
+            atexit.unregister(self.close)
+            thr = self.sending
+            self.sending = None
         if thr:
+            self._q.put(_SHUTDOWN)
             thr.join()
+            self.session.close()
+            if self._async:
+                self._async.close()
 
     def _raise_config_missing(self):
         m = []
@@ -156,80 +340,192 @@ class ObserveSender(object):
         }
 
     def _send_thread(self) -> None:
-        with self.cond:
-            while self._maybe_send_one():
-                self.cond.wait(BATCH_SEND_DELAY)
-    
-    def _maybe_send_one(self) -> bool:
-        now = time.time()
-        time_since_last_send = now - self.last_send
-        # maybe generate a keepalive
-        if self._is_time_for_keepalive(time_since_last_send):
-            # nanoseconds as string is preferred format
-            self.queue.append({'keepalive':str(now*1000000000)})
-        # maybe send a batch, if we're quitting, or it's time
-        if self._is_time_to_post(time_since_last_send):
-            if self._do_post():
-                # the batch succeeded
-                self.last_send = time.time()
-            elif not self.sending:
-                # we're quitting, and the batch failed
-                return False
-        # return "keep going" if I'm still running OR if there's still data to send
-        return self.sending or self.queue
-
-    def _is_time_for_keepalive(self, time_since_last_send: float) -> bool:
-        return not self.queue and time_since_last_send > KEEPALIVE_INTERVAL
-
-    def _is_time_to_post(self, time_since_last_send: float) -> bool:
-        return self.queue and ((not self.sending) or (time_since_last_send > BATCH_SEND_DELAY))
-
-    # Note that _do_post releases the lock while posting, and thus new data may
-    # arrive in the queue.
-    def _do_post(self) -> bool:
-        sendq = self.queue
-        self.queue = []
+        while True:
+            batch = self._next_batch()
+            if not batch and not self._closed.is_set() and time.time() - self.last_send > KEEPALIVE_INTERVAL:
+                # nanoseconds as string is preferred format
+                batch = [maybe_json({'keepalive':str(time.time_ns())})]
+            if batch:
+                if self._executor:
+                    self._inflight.acquire()
+                    self._executor.submit(self._post_and_release, batch)
+                elif not self._do_post(batch) and self._closed.is_set():
+                    # we're quitting, and the batch failed
+                    return
+            elif self._closed.is_set():
+                # closed, and everything has been drained
+                if self._executor:
+                    # wait out any in-flight batches, then give what they
+                    # put back one last try
+                    self._executor.shutdown(wait=True)
+                    if self._retry:
+                        self._do_post(list(self._retry))
+                return
+
+    # Worker-pool entry point: post one batch and release an in-flight slot.
+    def _post_and_release(self, batch: List[bytes]) -> None:
+        try:
+            self._do_post(batch)
+        finally:
+            self._inflight.release()
+
+    # Collect the next batch to post: anything left over from a failed post,
+    # then whatever arrives before the batching delay is up.
+    def _next_batch(self) -> List[bytes]:
+        # consume the retry deque destructively (each popleft is atomic);
+        # snapshot-and-clear would erase entries a failed worker extends
+        # in between
+        batch = []
+        while True:
+            try:
+                batch.append(self._retry.popleft())
+            except IndexError:
+                break
+        try:
+            # once closed there's no reason to linger; take only what's
+            # already there
+            batch.append(self._take(True, 0.0 if self._closed.is_set() else self._delay))
+        except queue.Empty:
+            return batch
+        # keep accumulating until a full batch delay has passed since the
+        # last send, so bursts coalesce into one POST
+        deadline = self.last_send + self._delay
+        while not self._closed.is_set():
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._take(True, remaining))
+            except queue.Empty:
+                break
+        # drain anything else that's already waiting, without blocking
+        while True:
+            try:
+                batch.append(self._take(False))
+            except queue.Empty:
+                return batch
+
+    # Pull one line off the queue, keeping the queued-bytes count honest.
+    def _take(self, block: bool, timeout: Optional[float]=None) -> bytes:
+        line = self._q.get(block, timeout)
+        if line is _SHUTDOWN:
+            # close() is waking us; _closed is already set, so ending the
+            # batch here lets the send loop run its drain-and-exit path
+            raise queue.Empty
+        with self._queued_lock:
+            self._queued_bytes -= len(line)
+        return line
+
+    # Nudge the batch delay so batches trend toward TARGET_BATCH_SIZE:
+    # wait longer when batches run small (coalescing more events per
+    # POST) and shorter when they run large, clamped to between half and
+    # double the configured BATCH_SEND_DELAY so latency stays bounded.
+    def _tune_delay(self, batch_size: int) -> None:
+        self._batch_ema += 0.2 * (batch_size - self._batch_ema)
+        target = BATCH_SEND_DELAY * (TARGET_BATCH_SIZE / max(self._batch_ema, 1.0))
+        self._delay = max(0.5 * BATCH_SEND_DELAY, min(target, 2.0 * BATCH_SEND_DELAY))
+
+    # Post one batch. Takes its data as an argument and runs with no lock
+    # held: the only shared state it touches is last_send (a single
+    # assignment, safe under the GIL) and the retry deque on failure.
+    def _do_post(self, sendq: List[bytes]) -> bool:
         try:
-            self.cond.release()
-            body = ('\n'.join([maybe_json(x) for x in sendq]) + '\n').encode('utf-8')
+            body = b'\n'.join(sendq) + b'\n'
             l = len(body)
+            if GZIP_SENDS:
+                body = gzip.compress(body, compresslevel=1)
             if self.log_sends:
-                print(f'ObserveSender sending count={len(sendq)} observations with size={l} bytes', flush=True)
-            response = requests.post(self.url, data=body, headers={
-                'Content-Type': 'application/x-ndjson',
-                'Content-Length': str(l),
-                'Authorization': f'Bearer {self.authtoken}',
-                })
-            response.raise_for_status()
-            self.cond.acquire()
+                print(f'ObserveSender sending count={len(sendq)} observations with size={l} bytes (wire={len(body)})', flush=True)
+            if self._async:
+                self._async.post(self.url, body)
+            else:
+                response = self.session.post(self.url, data=body, timeout=(5, 30))
+                response.raise_for_status()
+            self.last_send = time.time()
+            self._fail_count = 0
+            if ADAPTIVE_BATCHING:
+                self._tune_delay(len(sendq))
             return True
         except Exception as e:
-            traceback.print_exc()
-            time.sleep(0.25) # prevent runaway exceptions
-            self.cond.acquire()
-            # put the messages back, try again later
+            self._fail_count += 1
+            # only print the full traceback once per error class (and HTTP
+            # status), so a long outage doesn't flood stderr
+            errkey = (type(e).__name__, getattr(getattr(e, 'response', None), 'status_code', None))
+            if not errkey in self._warned_errors:
+                self._warned_errors.add(errkey)
+                traceback.print_exc()
+            # back off exponentially (capped, with jitter so retries don't
+            # storm the collector when it comes back); waiting on the
+            # closed Event instead of sleeping keeps close() prompt --
+            # it returns immediately once we're shutting down
+            self._closed.wait(min(30.0, 0.25 * 2**min(self._fail_count, 8)) + random.random()*0.1)
+            # save the messages, try again later
+            backlog = collections.deque(sendq)
             if l > MAX_BACKLOG_SAVE:
-                # if we've collected too much baggage, cut it down
-                numToDiscard = len(sendq)//2+1
+                # if we've collected too much baggage, cut it down from the
+                # head (oldest first), one O(1) popleft at a time
+                numToDiscard = len(backlog)//2+1
                 print(f'WARNING: ObserveSender discarding={numToDiscard} observations because failed to send={l} bytes: exception={repr(str(e))}', flush=True)
-                sendq = sendq[numToDiscard:]
-            sendq.extend(self.queue)
-            self.queue = sendq
+                for _ in range(numToDiscard):
+                    backlog.popleft()
+            # extend (not assign): concurrent workers may fail at once
+            self._retry.extend(backlog)
             return False
 
+class NullSender(object):
+    """A sender that silently drops everything, at zero per-event cost.
+
+    make_sender() returns one of these instead of an ObserveSender when
+    configuration is missing and accept_no_config is set, so callers don't
+    pay any dispatch or buffering overhead just to discover there's
+    nowhere to send.
+    """
+    enqueue = lambda *args, **kwargs: None
+    close = lambda *args, **kwargs: None
+
+def make_sender(host:Optional[str]=None, customerid:Optional[str]=None, authtoken:Optional[str]=None, path:Optional[str]=None, metadata_key:Optional[str]=None, accept_no_config:bool=False, log_sends=False):
+    """Build an ObserveSender, or a NullSender when accept_no_config is set
+    and the configuration (arguments or environment) is incomplete.
+
+    Without accept_no_config this behaves exactly like the ObserveSender
+    constructor, including raising on missing configuration.
+    """
+    if accept_no_config:
+        if not ((host or os.getenv("OBSERVE_HOST"))
+                and (customerid or os.getenv("OBSERVE_CUSTOMERID"))
+                and (authtoken or os.getenv("OBSERVE_AUTHTOKEN"))):
+            return NullSender()
+    return ObserveSender(host=host, customerid=customerid, authtoken=authtoken, path=path, metadata_key=metadata_key, accept_no_config=accept_no_config, log_sends=log_sends)
+
 def merge(*srcs:dict) -> dict:
-    dst = {}
-    for src in srcs:
-        for k, v in src.items():
-            if not k in dst:
-                dst[k] = v
+    if not srcs:
+        return {}
+    # first-wins: copy the first source with the C fast path, then fill
+    # in only the keys it's missing (keys() difference is C-implemented)
+    dst = dict(srcs[0])
+    for src in srcs[1:]:
+        for k in src.keys() - dst.keys():
+            dst[k] = src[k]
     return dst
 
 warned_unsupported = set()
 
-def maybe_json(obj: dict) -> str:
+def maybe_json(obj: dict, sort_keys: bool=False) -> bytes:
+    # NDJSON doesn't care about key order, so sorting (an O(k log k)
+    # Python-level comparison per record) is off unless the caller wants
+    # deterministic output for human debugging
     try:
-        return json.dumps(obj, ensure_ascii=False, sort_keys=True)
+        if orjson:
+            option = orjson.OPT_NON_STR_KEYS
+            if sort_keys:
+                option |= orjson.OPT_SORT_KEYS
+            # default=str mirrors the stdlib path below: leaves orjson
+            # can't encode natively (Decimal, bytes, sets, ...) stringify
+            # instead of poisoning the whole record
+            return orjson.dumps(obj, option=option, default=str)
+        # default=str keeps non-native leaves (datetimes, UUIDs from
+        # pydantic .dict()) serializable when orjson isn't installed
+        return json.dumps(obj, ensure_ascii=False, sort_keys=sort_keys, default=str).encode('utf-8')
     except Exception as e:
         # put something in the payload so you can sort it out later
         global warned_unsupported
@@ -238,4 +534,4 @@ def maybe_json(obj: dict) -> str:
         if not emsg in warned_unsupported:
             warned_unsupported.add(emsg)
             print(f'WARNING: ObserveTracer sending _unsupported because {emsg}', flush=True)
-        return json.dumps({'_unsupported':str(obj), 'error':str(e)}, ensure_ascii=False, sort_keys=True)
+        return json.dumps({'_unsupported':str(obj), 'error':str(e)}, ensure_ascii=False).encode('utf-8')
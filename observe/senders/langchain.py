@@ -1,11 +1,10 @@
-import json
 from typing import(List, Optional, Union, Dict)
 
 from langchain_core.tracers.schemas import Run
 from langchain_core.tracers.base import BaseTracer
 from langchain_core.outputs import (ChatGenerationChunk, GenerationChunk)
 
-from .base import ObserveSender
+from .base import (NullSender, ObserveSender, make_sender)
 
 
 class ObserveTracer(BaseTracer):
@@ -34,7 +33,22 @@ class ObserveTracer(BaseTracer):
     """
     def __init__(self, host:Optional[str]=None, customerid:Optional[str]=None, authtoken:Optional[str]=None, path:Optional[str]=None, accept_no_config:bool=False, log_sends:bool=False, log_new_tokens:bool=False):
         self.log_new_tokens = log_new_tokens
-        self.sender = ObserveSender(host=host, customerid=customerid, authtoken=authtoken, path=path, accept_no_config=accept_no_config, log_sends=log_sends)
+        if not log_new_tokens:
+            # tokens can stream at thousands per second; bind a true no-op
+            # on the instance so each one skips the method body entirely
+            self._on_llm_new_token = lambda run, token, chunk: None
+        self.sender = make_sender(host=host, customerid=customerid, authtoken=authtoken, path=path, accept_no_config=accept_no_config, log_sends=log_sends)
+        if isinstance(self.sender, NullSender):
+            # nothing will ever be sent, so make every callback a true
+            # no-op rather than paying dispatch per langchain event
+            noop = lambda *args, **kwargs: None
+            for name in ('_persist_run', '_on_run_create', '_on_run_update',
+                         '_on_llm_start', '_on_llm_new_token', '_on_llm_end', '_on_llm_error',
+                         '_on_chain_start', '_on_chain_end', '_on_chain_error',
+                         '_on_tool_start', '_on_tool_end', '_on_tool_error',
+                         '_on_retriever_start', '_on_retriever_end', '_on_retriever_error'):
+                setattr(self, name, noop)
+            return
         self.sender.enqueue('starting', {})
 
     def close(self) -> None:
@@ -101,8 +115,9 @@ class ObserveTracer(BaseTracer):
         self.sender.enqueue('retriever_error', self._run_to_dict(run=run, include_children=False))
 
     def _run_to_dict(self, run:Run, include_children:bool) -> dict:
-        data = json.loads(run.json())
-        if (not include_children) and ('child_runs' in data):
-            del data['child_runs']
-        return data
+        # Run is a pydantic model; .dict() gives us a plain dict without
+        # the serialize-then-parse round trip of json.loads(run.json()).
+        # Non-JSON-native leaves (datetimes, UUIDs) are handled by the
+        # sender's encoder.
+        return run.dict(exclude=None if include_children else {'child_runs'})
 